@@ -14,14 +14,22 @@
 # limitations under the License.
 #
 
-from __future__ import print_function
-
 import os
 import sys
 import argparse
 import subprocess
 import logging
 import re
+import locale
+import hashlib
+import multiprocessing
+import contextlib
+import functools
+import threading
+import select
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory, mkdtemp
 
 
 def main():
@@ -31,6 +39,7 @@ def main():
     _OS_EX_DATAERR=65
     KL_SUFFIX = '.kl'
     PCODE_SUFFIX = '.pc'
+    DEP_CACHE_SUFFIX = '.d'
 
     description=("Version {0}\n\n"
         "A wrapper around Fanuc Robotics' command-line Karel translator ({1})\n"
@@ -74,6 +83,19 @@ def main():
     parser.add_argument('-k', '--keep-build-dir', action='store_true',
         dest='keep_buildd', help="Don't delete the temporary build directory "
             "on exit")
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+        help="Always translate, even if the p-code file is newer than the "
+            "source and all headers it included, and don't leave a '<pc>.d' "
+            "dependency cache (a make rule) next to the p-code file (the "
+            "cache is also off when '-MF' names that same file)")
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', metavar='N',
+        default=multiprocessing.cpu_count(), help="Maximum number of "
+            "concurrent file system operations and, with --batch, "
+            "translations (default: number of CPUs)")
+    parser.add_argument('--batch', type=str, dest='batch_fname', metavar='FILE',
+        help="Translate all KAREL sources listed in FILE (one per line), "
+            "running up to '--jobs' translations in parallel (fewer if "
+            "GNU make's jobserver says so)")
     parser.add_argument('--ktrans', type=str, dest='ktrans_path', metavar='PATH',
         help="Location of ktrans (by default ktransw assumes it's on the "
             "Windows PATH)")
@@ -87,10 +109,8 @@ def main():
         "notation here")
 
     # support forward-slash arg notation for include dirs
-    for i in range(1, len(sys.argv)):
-        if sys.argv[i].startswith('/I'):
-            sys.argv[i] = sys.argv[i].replace('/I', '-I', 1)
-    args = parser.parse_args()
+    args = parser.parse_args(
+        ['-I' + arg[2:] if arg.startswith('/I') else arg for arg in sys.argv[1:]])
 
     # configure the logger
     FMT='%(levelname)-8s | %(message)s'
@@ -121,28 +141,62 @@ def main():
     #  3. everything else is a (potentially relative) path
     #
     # everything in category 3 is made absolute.
-    for i in range(0, len(args.ktrans_args)):
-        if (args.ktrans_args[i][0] != '/') and (args.ktrans_args[i][0] != 'V') and (args.ktrans_args[i][0] != 'v'):
-            args.ktrans_args[i] = os.path.abspath(args.ktrans_args[i])
-
-    logger.debug("Parsed args:")
-    for key, val in vars(args).iteritems():
-        if type(val) == list:
-            logger.debug("  {0}:".format(key))
-            for item in val:
-                logger.debug("    {0}".format(item))
-        else:
-            logger.debug("  {0}: {1}".format(key, val))
+    args.ktrans_args = [arg if arg[:1] in ('/', 'V', 'v') else os.path.abspath(arg)
+        for arg in args.ktrans_args]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Parsed args:")
+        for key, val in vars(args).items():
+            if type(val) == list:
+                logger.debug("  {0}:".format(key))
+                for item in val:
+                    logger.debug("    {0}".format(item))
+            else:
+                logger.debug("  {0}: {1}".format(key, val))
 
 
     # extract args which refer to KAREL sources: we can just search for
     # arguments with '.kl' in it, as ktrans only considers files with that
-    # extension.
-    kl_files = [arg for arg in args.ktrans_args if arg.endswith(KL_SUFFIX)]
+    # extension. Remember where they are, so we can swap in the preprocessed
+    # source later.
+    kl_entries = [(i, arg) for i, arg in enumerate(args.ktrans_args)
+        if arg.endswith(KL_SUFFIX)]
+
+    # in batch mode, we run ourselves on every listed source instead
+    if args.batch_fname:
+        if kl_entries or any(arg.endswith(PCODE_SUFFIX) for arg in args.ktrans_args):
+            parser.error("--batch cannot be combined with source or p-code arguments")
+        # these name a single output, which all translations would share
+        if args.dep_fname or args.dep_target or args.output_ppd_source:
+            parser.error("--batch cannot be combined with -MF, -MT or -E")
+        try:
+            kl_files = read_batch_file(args.batch_fname)
+        except OSError as e:
+            sys.stderr.write("ktransw: fatal error: {0}: {1}\n".format(args.batch_fname, e.strerror))
+            sys.exit(_OS_EX_DATAERR)
+        not_kl_files = [f for f in kl_files if not f.endswith(KL_SUFFIX)]
+        if not_kl_files:
+            sys.stderr.write("ktransw: fatal error: {0}: not a KAREL source: {1}\n"
+                .format(args.batch_fname, not_kl_files[0]))
+            sys.exit(_OS_EX_DATAERR)
+        # all p-code files end up in the current dir, so sources need unique
+        # base names (this also catches sources listed more than once)
+        pc_names = {}
+        for kl_file in kl_files:
+            pc_name = os.path.basename(os.path.splitext(kl_file)[0]) + PCODE_SUFFIX
+            key = os.path.normcase(pc_name)
+            if key in pc_names:
+                sys.stderr.write("ktransw: fatal error: {0}: {1} and {2} would both "
+                    "be translated to {3}\n".format(args.batch_fname, pc_names[key], kl_file, pc_name))
+                sys.exit(_OS_EX_DATAERR)
+            pc_names[key] = kl_file
+        logger.debug("Translating {0} sources from {1}".format(len(kl_files), args.batch_fname))
+        sys.exit(run_batch(kl_files, make_batch_child_args(args), args.jobs,
+            jobserver=get_jobserver(os.environ.get('MAKEFLAGS'))))
 
 
     # avoid running a build if we don't need it
-    needs_build = len(kl_files) > 0
+    needs_build = len(kl_entries) > 0
     logger.debug("{0} a build".format("Needs" if needs_build else "Doesn't need"))
 
     if not needs_build:
@@ -157,7 +211,7 @@ def main():
         sys.exit(ktrans_ret)
 
     # assume there's only one input source file (or: we ignore all others)
-    kl_file = kl_files[0]
+    (kl_idx, kl_file) = kl_entries[0]
 
     # checks done, can now proceed to actual pre-processing / translation ..
     # .. but only if not requested to do a dry-run
@@ -165,10 +219,37 @@ def main():
         logger.debug("Not calling ktrans or gpp: dry run requested")
         sys.exit(0)
 
+    # ktrans writes its output either to the p-code file given on the command
+    # line, or to a file with the base name of the source in the current dir
+    pc_files = [arg for arg in args.ktrans_args if arg.endswith(PCODE_SUFFIX)]
+    pc_file = pc_files[0] if pc_files else os.path.abspath(
+        os.path.basename(os.path.splitext(kl_file)[0]) + PCODE_SUFFIX)
+    dep_cache_file = get_dep_cache_file(pc_file + DEP_CACHE_SUFFIX, args.dep_fname)
+    logger.debug("Using dependency cache: {0}".format(dep_cache_file))
+
+    # the cache is only valid for the command line it was written for
+    build_key = make_build_key([ktrans_path, gpp_path]
+        + [os.path.abspath(d) for d in args.include_dirs] + args.ktrans_args)
+
+    # avoid running gpp and ktrans if the p-code file is newer than the source
+    # and all headers it included the last time it was translated. Requests
+    # for preprocessed source or dependency info always need a full run.
+    use_cache = (not args.no_cache) and (dep_cache_file is not None)
+    if (use_cache and not (args.output_ppd_source or args.dep_output
+            or args.ignore_syshdrs)):
+        # files passed on to ktrans (fi: the '/config' robot.ini) count as
+        # dependencies as well
+        arg_files = [arg for (i, arg) in enumerate(args.ktrans_args)
+            if (i != kl_idx) and (arg not in pc_files) and os.path.isfile(arg)]
+        deps = load_dep_cache(dep_cache_file, kl_file, build_key)
+        if (deps is not None) and is_up_to_date(pc_file, [kl_file] + arg_files + deps):
+            logger.debug("{0} is up to date".format(pc_file))
+            sys.exit(0)
+
     # create temporary directory to store preprocessed file in. We
     # avoid problems with temporary files (via NamedTemporaryFile fi) being
     # not readable by other processes in this way.
-    with TemporaryDirectory(prefix='ktransw-', suffix='-buildd', do_clean=(not args.keep_buildd)) as dname:
+    with build_directory(keep=args.keep_buildd) as dname:
         # unfortunately we need to create a temporary file to store the
         # preprocessed KAREL source in, as ktrans doesn't support reading
         # from stdin.
@@ -184,15 +265,11 @@ def main():
 
         # setup command line for gpp
         gpp_cmdline = setup_gpp_cline(gpp_path, kl_file, fname, args.include_dirs)
-        # TODO: why do we need to do this ourselves? gpp doesn't run
-        #       correctly if we don't, but it shouldn't matter?
-        gpp_cmdline = ' '.join(gpp_cmdline)
 
         # invoke gpp and save output
         logger.debug("Starting gpp as: '{0}'".format(gpp_cmdline))
-        gpp_proc = subprocess.Popen(gpp_cmdline, stdout=subprocess.PIPE,
+        gpp_proc = subprocess.run(gpp_cmdline, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
-        (pstdout, pstderr) = gpp_proc.communicate()
 
         logger.debug("End of gpp, ret: {0}".format(gpp_proc.returncode))
 
@@ -200,7 +277,7 @@ def main():
         if (gpp_proc.returncode != 0):
             sys.stderr.write(
                 "{}\n"
-                "Translation terminated\n".format(pstderr))
+                "Translation terminated\n".format(gpp_proc.stderr.decode(_TOOL_ENCODING, 'replace')))
 
             # TODO: this is not very nice, as it essentially merges the set of
             # possible exit codes of gpp with those of ktrans (and gpp's are
@@ -210,67 +287,33 @@ def main():
 
         # pre-processing done
 
-
         # see if we need to output dependency info
         if (args.dep_output or args.ignore_syshdrs):
             # use original filename for logging
             logger.debug("Dependency output for {0}".format(kl_file))
 
-            # but scan the GPP output for include markers
-            incs = get_includes_from_file(fname)
-            logger.debug("Found {0} includes".format(len(incs)))
-
             # target name we use is 'base source file name + .pc', OR the name
             # provided as a command line arg
             base_source_name = os.path.basename(os.path.splitext(kl_file)[0])
             target = args.dep_target or (base_source_name + PCODE_SUFFIX)
 
             # resolve all relative includes to their respective include directories
-            deps = []
-            for hdr in incs:
-                if args.ignore_syshdrs and is_system_header(hdr):
-                    logger.debug("Ignoring system header '{0}'".format(hdr))
-                    continue
-
-                # all non-absolute paths are headers we need to find first
-                hdr_path = hdr
-                if not os.path.isabs(hdr_path):
-                    try:
-                        hdr_dir = find_hdr_in_incdirs(hdr_path, args.include_dirs)
-
-                        # make relative header absolute by prefixing it with the
-                        # location we found it in
-                        hdr_path = os.path.join(hdr_dir, hdr_path)
-                        logger.debug("Found {0} in '{1}'".format(hdr, hdr_dir))
-
-                    except ValueError as e:
-                        if not args.ignore_missing_hdrs:
-                            # we were not asked to ignore this, so exit with an error
-                            sys.stderr.write("ktransw: fatal error: {0}: No such file or directory\n".format(hdr))
-                            sys.exit(_OS_EX_DATAERR)
-
-                logger.debug("Adding {0} to dependencies".format(hdr_path))
-                deps.append(hdr_path)
-
-            # escape spaces as ninja does not like those
-            for i in range(0, len(deps)):
-                deps[i] = deps[i].replace(' ', '\\ ')
-            target = target.replace(' ', '\\ ')
-
-            # write out dependency rules
-            dep_lines = '{0}: {1}\n'.format(target, ' '.join(['{}'.format(dep) for dep in deps]))
-
-            # and some phony targets if user requested that
-            if args.add_phony_tgt_for_deps:
-                dep_lines += '\n'.join([dep + ':' for dep in deps]) + '\n'
-
-            # write out dependency file
+            try:
+                deps = resolve_deps(fname, args.include_dirs, jobs=args.jobs,
+                    ignore_syshdrs=args.ignore_syshdrs,
+                    ignore_missing_hdrs=args.ignore_missing_hdrs)
+            except ValueError as e:
+                # we were not asked to ignore this, so exit with an error
+                sys.stderr.write("ktransw: fatal error: {0}: No such file or directory\n".format(e))
+                sys.exit(_OS_EX_DATAERR)
+            logger.debug("Found {0} dependencies".format(len(deps)))
+
+            # write out dependency file, or to stdout
             if args.dep_fname:
                 with open(args.dep_fname, 'w') as outf:
-                    outf.write(dep_lines)
-            # or to stdout
+                    write_dep_rules(outf, target, deps, args.add_phony_tgt_for_deps)
             else:
-                sys.stdout.write(dep_lines)
+                write_dep_rules(sys.stdout, target, deps, args.add_phony_tgt_for_deps)
 
 
         # output only pre-processed source if user asked for that
@@ -281,20 +324,12 @@ def main():
 
 
         # replace user specified source file with the preprocessed one
-        for i in range(0, len(args.ktrans_args)):
-            if (args.ktrans_args[i] == kl_file):
-                args.ktrans_args[i] = fname
-
-        # quote all paths as they may potentially contain spaces and ktrans
-        # (or the shell really) can't handle that
-        for i in range(0, len(args.ktrans_args)):
-            if (args.ktrans_args[i][0] != '/') and (args.ktrans_args[i][0] != 'V') and (args.ktrans_args[i][0] != 'v'):
-                args.ktrans_args[i] = '"{0}"'.format(args.ktrans_args[i])
-
-        # setup ktrans command line args
-        ktrans_cmdline = ['"{0}"'.format(ktrans_path)]
+        args.ktrans_args[kl_idx] = fname
+
+        # setup ktrans command line args. Passing them as a list lets
+        # subprocess take care of quoting paths with spaces in them.
+        ktrans_cmdline = [ktrans_path]
         ktrans_cmdline.extend(args.ktrans_args)
-        ktrans_cmdline = ' '.join(ktrans_cmdline)
 
         logger.debug("Starting ktrans as: '{}'".format(ktrans_cmdline))
         # NOTE: we remap stderr to stdout as ktrans doesn't use those
@@ -302,203 +337,514 @@ def main():
         # vice versa)
         ktrans_proc = subprocess.Popen(ktrans_cmdline, stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
-        (pstdout, _) = ktrans_proc.communicate()
+
+        # relay ktrans output as it is produced, or, if we're quiet, hold on
+        # to it in case ktrans fails. Either way, make it refer to the
+        # directory of the original source instead of our build dir.
+        # TODO: the error messages refer to lines in the temporary,
+        # preprocessed KAREL source file, not the original one.
+        show_output = (not args.quiet) or args.verbose
+        held_output = []
+        src_dir = os.path.dirname(kl_file)
+        for line in iter(ktrans_proc.stdout.readline, b''):
+            line = line.decode(_TOOL_ENCODING, 'replace').replace(dname, src_dir)
+            if show_output:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                held_output.append(line)
+        ktrans_proc.wait()
 
         # let caller know how we did
         logger.debug("End of ktrans, ret: {0}".format(ktrans_proc.returncode))
 
         # print ktrans output only on error or if we're not quiet
-        if (ktrans_proc.returncode != 0) or (not args.quiet) or args.verbose:
-            # TODO: we loose stdout/stderr interleaving here
-            # TODO: the error messages refer to lines in the temporary,
-            # preprocessed KAREL source file, not the original one.
-            sys.stdout.write(pstdout.replace(dname, os.path.dirname(kl_file)) + '\n')
+        if (ktrans_proc.returncode != 0) and not show_output:
+            sys.stdout.writelines(held_output)
+        if (ktrans_proc.returncode != 0) or show_output:
+            sys.stdout.write('\n')
+
+        # remember what we depended on, so the next run can skip translation
+        # if none of it changed
+        if use_cache and (ktrans_proc.returncode == 0):
+            deps = resolve_deps(fname, args.include_dirs, jobs=args.jobs,
+                ignore_missing_hdrs=True)
+            write_dep_cache(dep_cache_file, args.dep_target or os.path.basename(pc_file),
+                kl_file, deps, build_key)
 
         sys.exit(ktrans_proc.returncode)
 
 
+def resolve_deps(fname, include_dirs, jobs=1, ignore_syshdrs=False,
+        ignore_missing_hdrs=False):
+    # scan the (preprocessed) file for includes and resolve all relative ones
+    # to the include directory they were found in. Raises a ValueError for
+    # headers that cannot be found, unless asked to ignore those.
+    logger = logging.getLogger('ktransw')
+    deps = []
+
+    # only built once we come across a relative header: an index of headers
+    # in all include dirs (instead of looking for every header in every
+    # include dir separately), and include dirs ending in a separator, so
+    # headers with a directory component can be found by concatenation
+    incdir_index = None
+    sep_include_dirs = None
+
+    for hdr in get_includes_from_file(fname):
+        if ignore_syshdrs and is_system_header(hdr):
+            logger.debug("Ignoring system header '{0}'".format(hdr))
+            continue
+
+        # all non-absolute paths are headers we need to find first
+        hdr_path = hdr
+        if not os.path.isabs(hdr_path):
+            try:
+                # plain file names can be looked up in the index, anything
+                # with a directory component needs to be searched for
+                if os.path.dirname(hdr_path):
+                    if sep_include_dirs is None:
+                        sep_include_dirs = with_trailing_sep(include_dirs)
+                    hdr_dir = find_hdr_in_incdirs(hdr_path, sep_include_dirs)
+                else:
+                    if incdir_index is None:
+                        incdir_index = build_incdir_index(include_dirs, jobs=jobs)
+                    hdr_dir = find_hdr_in_index(hdr_path, incdir_index)
+
+                # make relative header absolute by prefixing it with the
+                # location we found it in
+                hdr_path = os.path.join(hdr_dir, hdr_path)
+                logger.debug("Found {0} in '{1}'".format(hdr, hdr_dir))
+
+            except ValueError:
+                if not ignore_missing_hdrs:
+                    raise ValueError(hdr)
+
+        logger.debug("Adding {0} to dependencies".format(hdr_path))
+        deps.append(hdr_path)
+    return deps
+
+
+def write_dep_rules(outf, target, deps, add_phony_tgts=False):
+    # escape spaces as ninja does not like those
+    outf.write(target.replace(' ', '\\ ') + ':')
+    for dep in deps:
+        outf.write(' ' + dep.replace(' ', '\\ '))
+    outf.write('\n')
+
+    # and some phony targets if user requested that
+    if add_phony_tgts:
+        for dep in deps:
+            outf.write(dep.replace(' ', '\\ ') + ':\n')
+
+
+def get_dep_cache_file(cache_file, dep_fname):
+    # returns 'cache_file', or None if the user asked for dependency output to
+    # be written to the same file (as ninja's '-MF $out.d' would): we must not
+    # overwrite that with our own
+    if dep_fname and (os.path.normcase(os.path.abspath(dep_fname))
+            == os.path.normcase(os.path.abspath(cache_file))):
+        return None
+    return cache_file
+
+
+def make_build_key(cmdline):
+    # a digest of everything (besides the dependencies) that influences the
+    # output of a translation: tools, include dirs and ktrans arguments
+    return hashlib.sha1('\0'.join(cmdline).encode('utf-8')).hexdigest()
+
+
+_BUILD_KEY_PREFIX = '# ktransw build key: '
+
+def load_dep_cache(cache_file, kl_file, build_key):
+    # returns the list of dependencies recorded for 'kl_file' by
+    # write_dep_cache, or None if there is no (usable) cache, or it was
+    # written for a different 'build_key'
+    try:
+        with open(cache_file, 'r') as inf:
+            key_line = inf.readline()
+            rule = inf.readline()
+    except OSError:
+        return None
+
+    if key_line.rstrip('\n') != _BUILD_KEY_PREFIX + build_key:
+        return None
+    (_, sep, prereqs) = rule.rstrip('\n').partition(': ')
+    deps = [dep.replace('\\ ', ' ') for dep in _DEP_SEP_RE.split(prereqs.strip())]
+    if (not sep) or (deps[0] != kl_file):
+        return None
+    return deps[1:]
+
+
+# prerequisites in a make rule are separated by unescaped spaces
+_DEP_SEP_RE = re.compile(r'(?<!\\) +')
+
+def write_dep_cache(cache_file, target, kl_file, deps, build_key):
+    # a make style rule, like GCC's '-MD' writes. The source comes first, so
+    # we can check it's still the one the cache was written for. The build
+    # key goes in a comment, which make ignores.
+    with open(cache_file, 'w') as outf:
+        outf.write(_BUILD_KEY_PREFIX + build_key + '\n')
+        write_dep_rules(outf, target, [kl_file] + deps)
+
+
+def is_up_to_date(target, deps):
+    # target is up to date if it exists and none of its dependencies is newer
+    try:
+        target_mtime = os.stat(target).st_mtime
+        return all(os.stat(dep).st_mtime <= target_mtime for dep in deps)
+    except OSError:
+        return False
+
+
 def get_includes_from_file(fname):
+    # memoised on path and modification time: the same (preprocessed) file
+    # gets scanned for both dependency output and the dependency cache
+    return list(_get_includes_cached(os.path.abspath(fname),
+        os.stat(fname).st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_includes_cached(abspath, mtime_ns):
+    return _read_includes_uncached(abspath)
+
+
+def _read_includes_uncached(fname):
     with open(fname, 'rb') as fd:
         source = fd.read()
-        return scan_for_inc_stmts(source)
+        return scan_for_inc_markers(source)
+
+
+# matches the include markers gpp emits (line:file:op) when it enters or
+# leaves an included file
+_INC_MARKER_RE = re.compile(br'^-- INCLUDE_MARKER (\d+):(\S+):(\d+|)', re.MULTILINE)
+GPP_OP_ENTER=b'1'
+GPP_OP_EXIT=b'2'
 
+# encoding used by gpp and ktrans when writing paths to their output
+_TOOL_ENCODING = locale.getpreferredencoding(False)
 
-GPP_OP_ENTER='1'
-GPP_OP_EXIT='2'
-def scan_for_inc_stmts(text):
-    matches = re.findall(r'^-- INCLUDE_MARKER (\d+):(\S+):(\d+|)', text, re.MULTILINE)
+def scan_for_inc_markers(text):
     incs = []
-    for (line_nr, fpath, op) in matches:
-        if (op == GPP_OP_ENTER) and (fpath not in incs):
-            incs.append(fpath)
+    seen = set()
+    for m in _INC_MARKER_RE.finditer(text):
+        fpath = m.group(2)
+        if (m.group(3) == GPP_OP_ENTER) and (fpath not in seen):
+            seen.add(fpath)
+            incs.append(fpath.decode(_TOOL_ENCODING, 'replace'))
     return incs
 
 
+# TODO: this is only a list of 'system headers' for V7.70-1
+_SYSTEM_HEADERS = frozenset([
+    "iosetup.kl",
+    "kldctptx.kl",
+    "kldcutil.kl",
+    "klersys.kl",
+    "klerxmlf.kl",
+    "klevaxdf.kl",
+    "klevccdf.kl",
+    "klevkeys.kl",
+    "klevkmsk.kl",
+    "klevksp.kl",
+    "klevtpe.kl",
+    "klevutil.kl",
+    "kliosop.kl",
+    "kliotyps.kl",
+    "kliouop.kl",
+    "klrdread.kl",
+    "klrdutil.kl",
+    "kluifdir.kl",
+    "passcons.kl",
+    "ppedef.kl",
+    "runform.kl",
+    "sledef.kl"
+])
+
 def is_system_header(header):
-    # TODO: this is only a list of 'system headers' for V7.70-1
-    return header in [
-        "iosetup.kl",
-        "kldctptx.kl",
-        "kldcutil.kl",
-        "klersys.kl",
-        "klerxmlf.kl",
-        "klevaxdf.kl",
-        "klevccdf.kl",
-        "klevkeys.kl",
-        "klevkmsk.kl",
-        "klevksp.kl",
-        "klevtpe.kl",
-        "klevutil.kl",
-        "kliosop.kl",
-        "kliotyps.kl",
-        "kliouop.kl",
-        "klrdread.kl",
-        "klrdutil.kl",
-        "kluifdir.kl",
-        "passcons.kl",
-        "ppedef.kl",
-        "runform.kl",
-        "sledef.kl"
-    ]
+    # file names are case-insensitive on Windows
+    return header.lower() in _SYSTEM_HEADERS
+
+
+def build_incdir_index(include_dirs, jobs=1):
+    # map (normalised) names of all entries in the include dirs to the first
+    # include dir they appear in, so that include dir order is respected.
+    # Listing directories is I/O bound, so do that concurrently if allowed.
+    if (jobs > 1) and (len(include_dirs) > 1):
+        with ThreadPoolExecutor(max_workers=min(jobs, len(include_dirs))) as ex:
+            listings = list(ex.map(_listdir_or_empty, include_dirs))
+    else:
+        listings = [_listdir_or_empty(d) for d in include_dirs]
+
+    idx = {}
+    for include_dir, entries in zip(include_dirs, listings):
+        for name in entries:
+            idx.setdefault(os.path.normcase(name), include_dir)
+    return idx
+
+
+def _listdir_or_empty(path):
+    try:
+        with os.scandir(path) as it:
+            return [entry.name for entry in it]
+    except OSError:
+        return []
+
+
+def find_hdr_in_index(header, incdir_index):
+    try:
+        return incdir_index[os.path.normcase(header)]
+    except KeyError:
+        raise ValueError()
+
+
+def with_trailing_sep(include_dirs):
+    seps = tuple(sep for sep in (os.sep, os.altsep) if sep)
+    return [d if d.endswith(seps) else d + os.sep for d in include_dirs]
 
 
 def find_hdr_in_incdirs(header, include_dirs):
+    # expects include dirs to end in a separator (see with_trailing_sep())
     for include_dir in include_dirs:
-        if os.path.exists(os.path.join(include_dir, header)):
+        if os.path.isfile(include_dir + header):
             return include_dir
     raise ValueError()
 
 
+# static part of the gpp command line (based on 'C++ compatibility mode', but
+# with some changes to better integrate -- style-wise -- with Karel sources)
+#
+# TODO: see if we can restore bw-compat with plain ktrans by setting the
+# 'macro start sequence' to '\n--#\w' or something similar (a KAREL
+# comment), and by pre-processing (with ktransw) all includes to add
+# the '.kl' extension that ktrans expects (although that does make it
+# impossible to use alternative file extensions)
+#
+# Maybe make it an option? ie: --ktrans-bw
+_GPP_STATIC = (
+    '+z',       # Set text mode to Unix mode (LF terminator)
+
+    '--includemarker', '-- INCLUDE_MARKER %:%:%',
+                # line:file:op
+
+    '-U',       # User-defined mode
+    '',         # the macro start sequence
+    '',         # the macro end sequence for a call without arguments
+    '(',        # the argument start sequence
+    ',',        # the argument separator
+    ')',        # the argument end sequence
+    '(',        # the list of characters to stack for argument balancing
+    ')',        # the list of characters to unstack
+    '#',        # the string to be used for referring to an argument by number
+    '',         # and finally the quote character (escapes embedded string chars)
+
+    '-M',       # User-defined mode specifications for meta-macros
+    '\\n%\\w',   # the macro start sequence
+    '\\n',      # the macro end sequence for a call without arguments
+    ' ',        # the argument start sequence
+    ' ',        # the argument separator
+    '\\n',      # the argument end sequence
+    '',         # the list of characters to stack for argument balancing
+    '',         # and the list of characters to unstack
+
+    # TODO: somehow line endings get screwed up with this
+    #'+c',       # Specify comments
+    #'--',       # the beginning of a comment
+    #'\\n',      # end of comment
+
+    # TODO: somehow line endings get screwed up with this
+    #'+s',       # Specify strings
+    #"'",        # the beginning of a string
+    #"'",        # the end of a string
+    #''          # string-quote character (escapes embedded string chars)
+)
+
 def setup_gpp_cline(gpp_exe, src_file, dest_file, include_dirs):
-    # setup gpp command line (based on 'C++ compatibility mode', but with some
-    # changes to better integrate -- style-wise -- with Karel sources)
-
-    # TODO: see if we can restore bw-compat with plain ktrans by setting the
-    # 'macro start sequence' to '\n--#\w' or something similar (a KAREL
-    # comment), and by pre-processing (with ktransw) all includes to add
-    # the '.kl' extension that ktrans expects (although that does make it
-    # impossible to use alternative file extensions)
-    #
-    # Maybe make it an option? ie: --ktrans-bw
-
-    gpp_cmdline = [
-        gpp_exe,
-
-        '+z',       # Set text mode to Unix mode (LF terminator)
-
-        '--includemarker "-- INCLUDE_MARKER %:%:%"',
-                    # line:file:op
-
-        '-U',       # User-defined mode
-        '""',       # the macro start sequence
-        '""',       # the macro end sequence for a call without arguments
-        '"("',      # the argument start sequence
-        '","',      # the argument separator
-        '")"',      # the argument end sequence
-        '"("',      # the list of characters to stack for argument balancing
-        '")"',      # the list of characters to unstack
-        '"#"',      # the string to be used for referring to an argument by number
-        '""',       # and finally the quote character (escapes embedded string chars)
-
-        '-M',       # User-defined mode specifications for meta-macros
-        '"\\n%\w"', # the macro start sequence
-        '"\\n"',    # the macro end sequence for a call without arguments
-        '" "',      # the argument start sequence
-        '" "',      # the argument separator
-        '"\\n"',    # the argument end sequence
-        '""',       # the list of characters to stack for argument balancing
-        '""',       # and the list of characters to unstack
-
-        # TODO: somehow line endings get screwed up with this
-        #'+c',       # Specify comments
-        #'"--"',     # the beginning of a comment
-        #'"\\n"',    # end of comment
-
-        # TODO: somehow line endings get screwed up with this
-        #'+s',       # Specify strings
-        #'"\'"',     # the beginning of a string
-        #'"\'"',     # the end of a string
-        #'""'        # string-quote character (escapes embedded string chars)
-    ]
+    gpp_cmdline = [gpp_exe]
+    gpp_cmdline.extend(_GPP_STATIC)
 
     # append include dirs we got from caller
-    gpp_cmdline.extend(['-I"{0}"'.format(d) for d in include_dirs])
+    gpp_cmdline.extend(['-I' + d for d in include_dirs])
 
     # make gpp output to temporary file immediately, so we can have
     # ktrans open that, instead of having to write to the intermediary file
     # ourselves
-    gpp_cmdline.extend(['-o "{0}"'.format(dest_file)])
+    gpp_cmdline.extend(['-o', dest_file])
 
     # finally: the input to gpp is the KAREL file that we are supposed
     # to be compiling
-    gpp_cmdline.extend(['"{0}"'.format(src_file)])
+    gpp_cmdline.append(src_file)
 
     return gpp_cmdline
 
 
-class TemporaryDirectory(object):
-    # http://stackoverflow.com/a/19299884
-    def __init__(self, suffix="", prefix="tmp", dir=None, do_clean=True):
-        from tempfile import mkdtemp
-        self._closed = False
-        self._do_clean = do_clean
-        self.name = None
-        self.name = mkdtemp(suffix, prefix, dir)
+def read_batch_file(fname):
+    # one source per line, empty lines are ignored
+    with open(fname, 'r') as inf:
+        return [line.strip() for line in inf if line.strip()]
+
+
+def make_batch_child_args(args):
+    # the command line (minus the source) to run ourselves with for every
+    # source in a batch: everything we were given, except '--batch'. The
+    # batch already runs '--jobs' translations at once, so each of those
+    # should not do things concurrently itself.
+    child_args = ['-j', '1']
+    for (flag, enabled) in (('-v', args.verbose), ('-q', args.quiet),
+            ('-d', args.dry_run), ('-M', args.dep_output),
+            ('-MM', args.ignore_syshdrs), ('-MG', args.ignore_missing_hdrs),
+            ('-MP', args.add_phony_tgt_for_deps), ('-k', args.keep_buildd),
+            ('--no-cache', args.no_cache)):
+        if enabled:
+            child_args.append(flag)
+    for (opt, val) in (('--ktrans', args.ktrans_path), ('--gpp', args.gpp_path)):
+        if val:
+            child_args.extend([opt, val])
+    child_args.extend(['-I' + d for d in args.include_dirs])
+    child_args.extend(args.ktrans_args)
+    return child_args
+
+
+def run_batch(kl_files, argv, jobs, jobserver=None):
+    # translate each source by running ourselves on it, with the same 'argv'.
+    # Translating a KAREL source never needs the p-code of another one, so
+    # there is no order to respect and all sources can be translated in
+    # parallel. Output of each translation is kept together and relayed in
+    # the order of 'kl_files'. Returns the first non-zero exit code, if any.
+    # If given a 'jobserver', every translation first needs a job slot.
+    def translate(kl_file):
+        with (jobserver.slot() if jobserver else contextlib.nullcontext()):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__)] + argv + [kl_file],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return (proc.returncode, proc.stdout, proc.stderr)
+
+    ret = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+        for (returncode, pstdout, pstderr) in ex.map(translate, kl_files):
+            for (stream, output) in ((sys.stdout, pstdout), (sys.stderr, pstderr)):
+                stream.flush()
+                stream.buffer.write(output)
+                stream.buffer.flush()
+            if (returncode != 0) and (ret == 0):
+                ret = returncode
+    return ret
+
+
+class JobServer(object):
+    # client side of GNU make's jobserver protocol. Like every job started by
+    # make, we get one implicit job slot: tokens only need to be acquired
+    # from the jobserver for any jobs we run in addition to that.
+    def __init__(self, acquire_token, release_token):
+        self._acquire_token = acquire_token
+        self._release_token = release_token
+        self._lock = threading.Lock()
+        self._implicit_free = True
+
+    def acquire(self):
+        with self._lock:
+            if self._implicit_free:
+                self._implicit_free = False
+                return None
+        return self._acquire_token()
+
+    def release(self, token):
+        if token is None:
+            with self._lock:
+                self._implicit_free = True
+        else:
+            self._release_token(token)
 
-    def __repr__(self):
-        return "<{} {!r}>".format(self.__class__.__name__, self.name)
+    @contextlib.contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
 
-    def __enter__(self):
-        return self.name
 
-    def cleanup(self, _warn=False):
-        if self.name and not self._closed and self._do_clean:
-            try:
-                self._rmtree(self.name)
-            except (TypeError, AttributeError) as ex:
-                if "None" not in str(ex):
-                    raise
-                print("ERROR: {!r} while cleaning up {!r}".format(ex, self,),
-                      file=_sys.stderr)
-                return
-            self._closed = True
-            if _warn:
-                self._warn("Implicitly cleaning up {!r}".format(self),
-                           ResourceWarning)
-
-    def __exit__(self, exc, value, tb):
-        self.cleanup()
-
-    def __del__(self):
-        self.cleanup(_warn=True)
-
-    _listdir = staticmethod(os.listdir)
-    _path_join = staticmethod(os.path.join)
-    _isdir = staticmethod(os.path.isdir)
-    _islink = staticmethod(os.path.islink)
-    _remove = staticmethod(os.remove)
-    _rmdir = staticmethod(os.rmdir)
-    import warnings as _warnings
-    _warn = _warnings.warn
-
-    def _rmtree(self, path):
-        for name in self._listdir(path):
-            fullname = self._path_join(path, name)
-            try:
-                isdir = self._isdir(fullname) and not self._islink(fullname)
-            except OSError:
-                isdir = False
-            if isdir:
-                self._rmtree(fullname)
-            else:
-                try:
-                    self._remove(fullname)
-                except OSError:
-                    pass
+def get_jobserver(makeflags):
+    # returns a JobServer for the jobserver described in 'makeflags', or None
+    # if there is none (or we can't use it, fi because make didn't pass it
+    # on to us: recipes need to be marked with '+' for that)
+    auths = re.findall(r'--jobserver-(?:auth|fds)=(\S+)', makeflags or '')
+    if not auths:
+        return None
+    auth = auths[-1]
+
+    if auth.startswith('fifo:'):
         try:
-            self._rmdir(path)
+            fd = os.open(auth[len('fifo:'):], os.O_RDWR)
         except OSError:
-            pass
+            return None
+        return _pipe_jobserver(fd, fd)
+
+    if ',' in auth:
+        try:
+            (rfd, wfd) = [int(fd) for fd in auth.split(',', 1)]
+            # make sure these are really (still) the jobserver's pipe
+            if not all(stat.S_ISFIFO(os.fstat(fd).st_mode) for fd in (rfd, wfd)):
+                return None
+        except (ValueError, OSError):
+            return None
+        return _pipe_jobserver(rfd, wfd)
+
+    # on Windows, make uses a named semaphore
+    if os.name == 'nt':
+        return _semaphore_jobserver(auth)
+    return None
+
+
+def _pipe_jobserver(rfd, wfd):
+    def acquire_token():
+        while True:
+            try:
+                token = os.read(rfd, 1)
+            except BlockingIOError:
+                # make may have made the pipe non-blocking
+                select.select([rfd], [], [])
+                continue
+            if not token:
+                raise OSError("jobserver closed")
+            return token
+
+    def release_token(token):
+        os.write(wfd, token)
+
+    return JobServer(acquire_token, release_token)
+
+
+def _semaphore_jobserver(name):
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.OpenSemaphoreW.restype = ctypes.c_void_p
+    SYNCHRONIZE = 0x00100000
+    SEMAPHORE_MODIFY_STATE = 0x0002
+    INFINITE = 0xFFFFFFFF
+
+    handle = kernel32.OpenSemaphoreW(SYNCHRONIZE | SEMAPHORE_MODIFY_STATE,
+        False, name)
+    if not handle:
+        return None
+
+    def acquire_token():
+        kernel32.WaitForSingleObject(ctypes.c_void_p(handle), INFINITE)
+        return True
+
+    def release_token(token):
+        kernel32.ReleaseSemaphore(ctypes.c_void_p(handle), 1, None)
+
+    return JobServer(acquire_token, release_token)
+
+
+@contextlib.contextmanager
+def build_directory(keep=False):
+    # a temporary directory that is removed on exit, unless asked to keep it
+    if keep:
+        yield mkdtemp(prefix='ktransw-', suffix='-buildd')
+    else:
+        with TemporaryDirectory(prefix='ktransw-', suffix='-buildd') as dname:
+            yield dname
 
 
 if __name__ == '__main__':
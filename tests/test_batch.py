@@ -0,0 +1,32 @@
+import argparse
+
+from ktransw import read_batch_file, make_batch_child_args, run_batch
+
+
+def test_read_batch_file(tmpdir):
+    batch_file = tmpdir.join('sources.txt')
+    batch_file.write('foo.kl\n\n  C:\\src\\bar.kl  \n')
+    assert read_batch_file(str(batch_file)) == ['foo.kl', 'C:\\src\\bar.kl']
+
+
+def test_batch_child_args():
+    args = argparse.Namespace(verbose=False, quiet=True, dry_run=False,
+        dep_output=True, ignore_syshdrs=False, ignore_missing_hdrs=False,
+        add_phony_tgt_for_deps=True, keep_buildd=False, no_cache=False,
+        ktrans_path=None, gpp_path='C:\\gpp\\gpp.exe',
+        include_dirs=['C:\\inc', 'include'], batch_fname='sources.txt',
+        ktrans_args=['/config', 'C:\\robot.ini'])
+    assert make_batch_child_args(args) == ['-j', '1', '-q', '-M', '-MP',
+        '--gpp', 'C:\\gpp\\gpp.exe', '-IC:\\inc', '-Iinclude',
+        '/config', 'C:\\robot.ini']
+
+
+def test_run_batch_dry_run(tmpdir):
+    kl_files = [str(tmpdir.join('prog{0}.kl'.format(i))) for i in range(4)]
+    assert run_batch(kl_files, ['-d'], 2) == 0
+
+
+def test_run_batch_failure(tmpdir):
+    # an unknown option makes every translation fail
+    kl_files = [str(tmpdir.join('prog.kl'))]
+    assert run_batch(kl_files, ['--no-such-option'], 2) != 0
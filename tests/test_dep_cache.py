@@ -0,0 +1,83 @@
+import os
+
+from ktransw import (load_dep_cache, write_dep_cache, is_up_to_date,
+    make_build_key, get_dep_cache_file)
+
+
+KEY = make_build_key(['ktrans.exe', 'gpp.exe', 'C:\\src\\prog.kl'])
+
+
+def test_cache_roundtrip(tmpdir):
+    cache_file = str(tmpdir.join('prog.pc.d'))
+    deps = ['C:\\inc\\foo.klt', 'C:\\my inc\\bar.klt']
+    write_dep_cache(cache_file, 'C:\\out\\prog.pc', 'C:\\src\\prog.kl', deps, KEY)
+    assert load_dep_cache(cache_file, 'C:\\src\\prog.kl', KEY) == deps
+
+
+def test_cache_is_make_rule(tmpdir):
+    cache_file = tmpdir.join('prog.pc.d')
+    write_dep_cache(str(cache_file), 'prog.pc', 'prog.kl', ['foo.klt'], KEY)
+    assert cache_file.read() == ('# ktransw build key: ' + KEY + '\n'
+        'prog.pc: prog.kl foo.klt\n')
+
+
+def test_cache_no_deps(tmpdir):
+    cache_file = str(tmpdir.join('prog.pc.d'))
+    write_dep_cache(cache_file, 'prog.pc', 'prog.kl', [], KEY)
+    assert load_dep_cache(cache_file, 'prog.kl', KEY) == []
+
+
+def test_cache_other_source(tmpdir):
+    cache_file = str(tmpdir.join('prog.pc.d'))
+    write_dep_cache(cache_file, 'prog.pc', 'C:\\src\\prog.kl', [], KEY)
+    assert load_dep_cache(cache_file, 'C:\\src\\other.kl', KEY) is None
+
+
+def test_cache_other_cmdline(tmpdir):
+    cache_file = str(tmpdir.join('prog.pc.d'))
+    write_dep_cache(cache_file, 'prog.pc', 'prog.kl', [], KEY)
+    other_key = make_build_key(['ktrans.exe', 'gpp.exe', 'C:\\src\\prog.kl',
+        '/ver', 'V9.10-1'])
+    assert other_key != KEY
+    assert load_dep_cache(cache_file, 'prog.kl', other_key) is None
+
+
+def test_cache_missing_or_corrupt(tmpdir):
+    cache_file = tmpdir.join('prog.pc.d')
+    assert load_dep_cache(str(cache_file), 'prog.kl', KEY) is None
+    cache_file.write('prog.pc: foo.klt')
+    assert load_dep_cache(str(cache_file), 'prog.kl', KEY) is None
+    cache_file.write('{"prog.kl": []}')
+    assert load_dep_cache(str(cache_file), 'prog.kl', KEY) is None
+
+
+def test_up_to_date(tmpdir):
+    target = tmpdir.join('prog.pc')
+    dep = tmpdir.join('prog.kl')
+    dep.write('')
+    target.write('')
+    os.utime(str(dep), (1000, 1000))
+    os.utime(str(target), (2000, 2000))
+    assert is_up_to_date(str(target), [str(dep)])
+
+    os.utime(str(dep), (3000, 3000))
+    assert not is_up_to_date(str(target), [str(dep)])
+
+
+def test_up_to_date_missing_files(tmpdir):
+    target = tmpdir.join('prog.pc')
+    dep = tmpdir.join('prog.kl')
+    dep.write('')
+    assert not is_up_to_date(str(target), [str(dep)])
+
+    target.write('')
+    assert not is_up_to_date(str(target), [str(dep), str(tmpdir.join('gone.klt'))])
+
+
+def test_cache_file_clashes_with_dep_file(tmpdir):
+    cache_file = str(tmpdir.join('prog.pc.d'))
+    assert get_dep_cache_file(cache_file, None) == cache_file
+    assert get_dep_cache_file(cache_file, str(tmpdir.join('prog.d'))) == cache_file
+    assert get_dep_cache_file(cache_file, cache_file) is None
+    with tmpdir.as_cwd():
+        assert get_dep_cache_file(cache_file, 'prog.pc.d') is None
@@ -0,0 +1,28 @@
+import io
+
+from ktransw import write_dep_rules
+
+
+def test_dep_rules():
+    outf = io.StringIO()
+    write_dep_rules(outf, 'prog.pc', ['C:\\inc\\foo.klt', 'C:\\inc\\bar.klt'])
+    assert outf.getvalue() == 'prog.pc: C:\\inc\\foo.klt C:\\inc\\bar.klt\n'
+
+
+def test_dep_rules_no_deps():
+    outf = io.StringIO()
+    write_dep_rules(outf, 'prog.pc', [])
+    assert outf.getvalue() == 'prog.pc:\n'
+
+
+def test_dep_rules_escape_spaces():
+    outf = io.StringIO()
+    write_dep_rules(outf, 'my prog.pc', ['C:\\my inc\\foo.klt'], add_phony_tgts=True)
+    assert outf.getvalue() == ('my\\ prog.pc: C:\\my\\ inc\\foo.klt\n'
+        'C:\\my\\ inc\\foo.klt:\n')
+
+
+def test_dep_rules_phony():
+    outf = io.StringIO()
+    write_dep_rules(outf, 'prog.pc', ['foo.klt', 'bar.klt'], add_phony_tgts=True)
+    assert outf.getvalue() == 'prog.pc: foo.klt bar.klt\nfoo.klt:\nbar.klt:\n'
@@ -1,142 +1,72 @@
+from ktransw import scan_for_inc_markers
 
-from ktransw import scan_for_inc_stmts
+
+def marker(fpath, op, line_nr=1):
+    return '-- INCLUDE_MARKER {0}:{1}:{2}'.format(line_nr, fpath, op).encode('ascii')
 
 
 def test_bare_includes():
     inc_path = 'foo'
-    incs = scan_for_inc_stmts('%INCLUDE ' + inc_path)
-    assert len(incs) == 1
-    assert inc_path in incs
+    incs = scan_for_inc_markers(marker(inc_path, 1))
+    assert incs == [inc_path]
 
     inc_path = 'foo'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'foo\bar'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
+    incs = scan_for_inc_markers(b'\n' + marker(inc_path, 1) + b'\n')
+    assert incs == [inc_path]
 
-    inc_path = 'foo\bar\baz'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
+    inc_path = 'C:\\foo\\bar'
+    incs = scan_for_inc_markers(b'\n' + marker(inc_path, 1) + b'\n')
+    assert incs == [inc_path]
 
 
 def test_includes_with_extension():
-    inc_path = 'foo.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
+    for inc_path in ['foo.klt', 'C:\\foo\\bar.klt', 'inc/foo/bar.h']:
+        incs = scan_for_inc_markers(b'\n' + marker(inc_path, 1, 23) + b'\n')
+        assert incs == [inc_path]
+
 
-    inc_path = 'foo\bar.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
+def test_includes_with_double_extension():
+    for inc_path in ['baz.baz.h', 'baz.baz.k.h', 'baz.baz.k.h.j.y..ddd.d.d.t..u.a.zzz']:
+        incs = scan_for_inc_markers(b'\n' + marker(inc_path, 1) + b'\n')
+        assert incs == [inc_path]
 
-    inc_path = 'foo\bar\baz.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
 
-    inc_path = 'foo\bar\\baz.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
+def test_only_entering_counts():
+    # leaving an include, or the marker for the main file, is not an include
+    assert scan_for_inc_markers(marker('foo.klt', 2)) == []
+    assert scan_for_inc_markers(marker('C:\\src\\prog.kl', '')) == []
 
 
-def test_includes_with_double_extension():
-    inc_path = 'baz.baz.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'baz.baz.k.h'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    # illegal, but ok
-    inc_path = 'baz.baz.k.h.j.y.s.f.r.w..ddd.d.d.t..u.a.zzz.zz.uu'
-    incs = scan_for_inc_stmts('\n%INCLUDE ' + inc_path + '\n')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-
-def test_whitespace():
-    inc_path = 'foo\bar.h'
-    incs = scan_for_inc_stmts('%INCLUDE       ' + inc_path)
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'foo\bar.h'
-    incs = scan_for_inc_stmts('    %INCLUDE       ' + inc_path + '    ')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'foo\bar.h'
-    incs = scan_for_inc_stmts(' \n  \n  \t\t \n \t\t%INCLUDE\t\t' + inc_path + '  \t    ')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'foo\bar.h'
-    incs = scan_for_inc_stmts('%INCLUDE\t  \t' + inc_path)
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    # but whitespace *inside* paths is illegal, and should not be stripped,
-    # but it won't match correctly either
-    inc_path = 'foo\  bar.h'
-    incs = scan_for_inc_stmts('%INCLUDE\t  \t' + inc_path)
-    assert len(incs) == 1
-    assert 'foo\\' in incs
-
-
-def test_comments():
-    # no space between filename and comment: illegal in ktrans
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('%INCLUDE ' + inc_path + '-- this is a comment')
-    assert len(incs) == 1
-    assert inc_path + '--' in incs
-
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('  \t\n\t%INCLUDE\t  \t' + inc_path + ' -- this is a comment')
-    assert len(incs) == 1
-    assert inc_path in incs
-
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('--%INCLUDE ' + inc_path + ' -- this is a comment')
-    assert len(incs) == 0
-
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('--    %INCLUDE ' + inc_path)
-    assert len(incs) == 0
-
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('    -- %INCLUDE ' + inc_path)
-    assert len(incs) == 0
-
-    inc_path = 'baz.h'
-    incs = scan_for_inc_stmts('\t  \t   -- %INCLUDE ' + inc_path)
-    assert len(incs) == 0
-
-
-def test_multiple_lines():
-    inc_paths = ['foo.h', 'bar.th']
-    incs = scan_for_inc_stmts('\n'.join(['%INCLUDE ' + p for p in inc_paths]))
-    assert len(incs) == len(inc_paths)
-    assert inc_paths <= incs and inc_paths >= incs
-
-    inc_paths = ['foo.h', 'bar.th', 'long_filename_with_underscores.h.hh', r'some\nested\path\and_underscore.kl']
-    incs = scan_for_inc_stmts('\n'.join(['  \t\n\t%INCLUDE ' + p + ' -- this is a comment' for p in inc_paths]))
-    assert len(incs) == len(inc_paths)
-    assert inc_paths <= incs and inc_paths >= incs
-
-    inc_paths = ['foo.h', 'bar.th']
-    inc_stmts = ['%INCLUDE ' + p for p in inc_paths]
-    inc_stmts.extend(['--%INCLUDE baz.th', '--%INCLUDE baz2.th -- another comment'])
-    inc_stmts.extend(['-- %INCLUDE baz.th', ' \t  --%INCLUDE baz2.th'])
-    incs = scan_for_inc_stmts('\n'.join(inc_stmts))
-    assert len(incs) == len(inc_paths)
-    assert inc_paths <= incs and inc_paths >= incs
+def test_not_a_marker():
+    assert scan_for_inc_markers(b'%INCLUDE klevkeys') == []
+    assert scan_for_inc_markers(b'  ' + marker('foo.klt', 1)) == []
+    assert scan_for_inc_markers(b'-- ' + marker('foo.klt', 1)) == []
+
+
+def test_include_markers():
+    text = b'\n'.join([
+        b'-- INCLUDE_MARKER 1:C:\\src\\prog.kl:',
+        b'-- INCLUDE_MARKER 3:C:\\inc\\foo.klt:1',
+        b'-- INCLUDE_MARKER 1:C:\\inc\\bar.klt:1',
+        b'-- INCLUDE_MARKER 5:C:\\inc\\foo.klt:2',
+        b'-- INCLUDE_MARKER 7:C:\\inc\\foo.klt:1',
+        b'%INCLUDE klevkeys',
+    ])
+    incs = scan_for_inc_markers(text)
+    assert incs == ['C:\\inc\\foo.klt', 'C:\\inc\\bar.klt']
+
+
+def test_includes_from_file_memoised(tmpdir, monkeypatch):
+    import ktransw
+
+    src = tmpdir.join('prog.kl')
+    src.write(b'-- INCLUDE_MARKER 1:foo.klt:1\n', mode='wb')
+
+    reads = []
+    orig = ktransw._read_includes_uncached
+    monkeypatch.setattr(ktransw, '_read_includes_uncached',
+        lambda f: reads.append(f) or orig(f))
+
+    assert ktransw.get_includes_from_file(str(src)) == ['foo.klt']
+    assert ktransw.get_includes_from_file(str(src)) == ['foo.klt']
+    assert len(reads) == 1
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from ktransw import (build_incdir_index, find_hdr_in_index,
+    find_hdr_in_incdirs, with_trailing_sep)
+
+
+def test_index_respects_incdir_order(tmpdir):
+    inc_a = tmpdir.mkdir('a')
+    inc_b = tmpdir.mkdir('b')
+    inc_a.join('foo.klt').write('')
+    inc_b.join('foo.klt').write('')
+    inc_b.join('bar.klt').write('')
+
+    idx = build_incdir_index([str(inc_a), str(inc_b)])
+    assert find_hdr_in_index('foo.klt', idx) == str(inc_a)
+    assert find_hdr_in_index('bar.klt', idx) == str(inc_b)
+
+
+def test_index_missing(tmpdir):
+    idx = build_incdir_index([str(tmpdir), str(tmpdir.join('does_not_exist'))])
+    with pytest.raises(ValueError):
+        find_hdr_in_index('foo.klt', idx)
+
+
+def test_index_concurrent(tmpdir):
+    inc_dirs = []
+    for i in range(8):
+        d = tmpdir.mkdir('inc{0}'.format(i))
+        d.join('common.klt').write('')
+        d.join('hdr{0}.klt'.format(i)).write('')
+        inc_dirs.append(str(d))
+
+    assert build_incdir_index(inc_dirs, jobs=4) == build_incdir_index(inc_dirs)
+    idx = build_incdir_index(inc_dirs, jobs=4)
+    assert find_hdr_in_index('common.klt', idx) == inc_dirs[0]
+    assert find_hdr_in_index('hdr5.klt', idx) == inc_dirs[5]
+
+
+def test_find_hdr_with_dir_component(tmpdir):
+    inc_a = tmpdir.mkdir('a')
+    inc_b = tmpdir.mkdir('b')
+    inc_b.mkdir('sub').join('foo.klt').write('')
+    # a directory is not a header
+    inc_a.mkdir('sub').mkdir('foo.klt')
+
+    include_dirs = with_trailing_sep([str(inc_a), str(inc_b) + os.sep])
+    assert all(d.endswith(os.sep) for d in include_dirs)
+    assert not include_dirs[1].endswith(os.sep + os.sep)
+
+    hdr = os.path.join('sub', 'foo.klt')
+    assert find_hdr_in_incdirs(hdr, include_dirs) == include_dirs[1]
+    with pytest.raises(ValueError):
+        find_hdr_in_incdirs(os.path.join('sub', 'bar.klt'), include_dirs)
@@ -0,0 +1,55 @@
+import os
+
+from ktransw import get_jobserver, run_batch
+
+
+def test_no_jobserver():
+    assert get_jobserver(None) is None
+    assert get_jobserver('') is None
+    assert get_jobserver(' -j4') is None
+
+
+def test_jobserver_unusable_fds(tmpdir):
+    # fds that were not passed on by make
+    assert get_jobserver(' -j4 --jobserver-auth=997,998') is None
+
+    # fds that are something else than the jobserver pipe
+    with open(str(tmpdir.join('f')), 'w') as f:
+        fd = f.fileno()
+        assert get_jobserver(' -j4 --jobserver-auth={0},{0}'.format(fd)) is None
+
+
+def test_jobserver_pipe():
+    (rfd, wfd) = os.pipe()
+    try:
+        os.write(wfd, b'ab')
+        js = get_jobserver(' -j3 --jobserver-auth={0},{1}'.format(rfd, wfd))
+        assert js is not None
+
+        # the first slot is our implicit one, further ones cost a token
+        implicit = js.acquire()
+        assert implicit is None
+        tokens = [js.acquire(), js.acquire()]
+        assert sorted(tokens) == [b'a', b'b']
+
+        for token in tokens + [implicit]:
+            js.release(token)
+        assert sorted([os.read(rfd, 1), os.read(rfd, 1)]) == [b'a', b'b']
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+
+def test_run_batch_with_jobserver(tmpdir):
+    (rfd, wfd) = os.pipe()
+    try:
+        os.write(wfd, b'a')
+        js = get_jobserver(' -j2 --jobserver-auth={0},{1}'.format(rfd, wfd))
+        kl_files = [str(tmpdir.join('prog{0}.kl'.format(i))) for i in range(4)]
+        assert run_batch(kl_files, ['-d'], 4, jobserver=js) == 0
+
+        # all tokens were returned
+        assert os.read(rfd, 1) == b'a'
+    finally:
+        os.close(rfd)
+        os.close(wfd)
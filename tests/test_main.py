@@ -0,0 +1,114 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+KTRANSW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ktransw.py')
+
+# stand-ins for gpp and ktrans: gpp copies its input, emitting an include
+# marker for every header passed in GPP_HEADERS, ktrans writes a p-code file
+GPP_STUB = '''#!{python}
+import os, sys
+args = sys.argv[1:]
+with open(args[args.index('-o') + 1], 'w') as outf:
+    for hdr in filter(None, os.environ.get('GPP_HEADERS', '').split(os.pathsep)):
+        outf.write('-- INCLUDE_MARKER 1:' + hdr + ':1\\n')
+    outf.write(open(args[-1]).read())
+'''
+KTRANS_STUB = '''#!{python}
+import os, sys
+src = [a for a in sys.argv[1:] if a.endswith('.kl')][0]
+print('Translating ' + os.path.basename(src))
+open(os.path.splitext(os.path.basename(src))[0] + '.pc', 'w').write('pc')
+'''
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='stub tools need a POSIX shebang')
+
+
+@pytest.fixture
+def ktransw(tmpdir):
+    bindir = tmpdir.mkdir('bin')
+    for name, stub in (('gpp', GPP_STUB), ('ktrans', KTRANS_STUB)):
+        script = bindir.join(name)
+        script.write(stub.format(python=sys.executable))
+        script.chmod(0o755)
+
+    def run(*args, **kwargs):
+        env = dict(os.environ, GPP_HEADERS=os.pathsep.join(kwargs.get('headers', [])))
+        env.pop('MAKEFLAGS', None)
+        cmdline = [sys.executable, KTRANSW, '--gpp', str(bindir.join('gpp')),
+            '--ktrans', str(bindir.join('ktrans'))] + list(args)
+        proc = subprocess.Popen(cmdline, cwd=str(tmpdir), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        return (proc.returncode, out.decode(), err.decode())
+
+    return run
+
+
+def test_dep_file_at_cache_location_is_kept(tmpdir, ktransw):
+    tmpdir.join('prog.kl').write('PROGRAM prog\n')
+    hdr = tmpdir.join('foo.klt')
+    hdr.write('')
+    (ret, _, _) = ktransw('-MM', '-MP', '-MF', 'prog.pc.d', 'prog.kl',
+        headers=['klevkeys.kl', str(hdr)])
+    assert ret == 0
+    assert tmpdir.join('prog.pc.d').read() == 'prog.pc: {0}\n{0}:\n'.format(hdr)
+
+
+def test_batch_abbreviated_option(tmpdir, ktransw):
+    for name in ('foo', 'bar'):
+        tmpdir.join(name + '.kl').write('PROGRAM {0}\n'.format(name))
+    tmpdir.join('sources.txt').write('foo.kl\nbar.kl\n')
+    (ret, out, _) = ktransw('--bat', 'sources.txt')
+    assert ret == 0
+    assert out.index('Translating foo.kl') < out.index('Translating bar.kl')
+    assert tmpdir.join('foo.pc').check() and tmpdir.join('bar.pc').check()
+
+
+def test_batch_rejects_non_kl_entries(tmpdir, ktransw):
+    tmpdir.join('sources.txt').write('foo.kl\nPROG.KL\n')
+    (ret, _, err) = ktransw('--batch', 'sources.txt')
+    assert ret == 65
+    assert 'PROG.KL' in err
+
+
+@pytest.mark.parametrize('opts', [['-M', '-MF', 'deps.d'], ['-M', '-MT', 'prog.pc'], ['-E']])
+def test_batch_rejects_single_output_options(tmpdir, ktransw, opts):
+    tmpdir.join('sources.txt').write('foo.kl\n')
+    (ret, _, err) = ktransw(*(opts + ['--batch', 'sources.txt']))
+    assert ret == 2
+    assert '--batch cannot be combined with -MF, -MT or -E' in err
+
+
+def test_changed_config_file_retranslates(tmpdir, ktransw):
+    tmpdir.join('prog.kl').write('PROGRAM prog\n')
+    robot_ini = tmpdir.join('robot.ini')
+    robot_ini.write('[WinOLPC_Util]\nVersion=V8.30-1\n')
+    os.utime(str(robot_ini), (1000, 1000))
+
+    (ret, out, _) = ktransw('prog.kl', '/config', 'robot.ini')
+    assert ret == 0 and 'Translating prog.kl' in out
+
+    # nothing changed: nothing to do
+    (ret, out, _) = ktransw('prog.kl', '/config', 'robot.ini')
+    assert ret == 0 and 'Translating' not in out
+
+    robot_ini.write('[WinOLPC_Util]\nVersion=V9.10-1\n')
+    os.utime(str(robot_ini), (time.time() + 10, time.time() + 10))
+    (ret, out, _) = ktransw('prog.kl', '/config', 'robot.ini')
+    assert ret == 0 and 'Translating prog.kl' in out
+
+
+@pytest.mark.parametrize('sources', [['a/prog.kl', 'b/prog.kl'], ['prog.kl', 'prog.kl'],
+    ['a/prog.kl', 'PROG.kl']])
+def test_batch_rejects_shared_outputs(tmpdir, ktransw, sources):
+    if os.path.normcase('PROG') != os.path.normcase('prog') and 'PROG.kl' in sources:
+        pytest.skip('file names are case sensitive here')
+    tmpdir.join('sources.txt').write('\n'.join(sources) + '\n')
+    (ret, _, err) = ktransw('--batch', 'sources.txt')
+    assert ret == 65
+    assert 'would both be translated to' in err
+    assert not tmpdir.join('prog.pc').check()
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import ktransw
+from ktransw import resolve_deps
+
+
+def write_markers(path, hdrs):
+    path.write(''.join('-- INCLUDE_MARKER 1:{0}:1\n'.format(h) for h in hdrs))
+
+
+def test_resolve_relative_headers(tmpdir):
+    inc = tmpdir.mkdir('inc')
+    inc.join('foo.klt').write('')
+    inc.mkdir('sub').join('bar.klt').write('')
+    src = tmpdir.join('prog.kl')
+    write_markers(src, ['foo.klt', os.path.join('sub', 'bar.klt')])
+
+    deps = resolve_deps(str(src), [str(tmpdir), str(inc)])
+    assert deps == [str(inc.join('foo.klt')), str(inc.join('sub', 'bar.klt'))]
+
+
+def test_resolve_missing_header(tmpdir):
+    src = tmpdir.join('prog.kl')
+    write_markers(src, ['foo.klt'])
+    with pytest.raises(ValueError):
+        resolve_deps(str(src), [str(tmpdir)])
+    assert resolve_deps(str(src), [str(tmpdir)], ignore_missing_hdrs=True) == ['foo.klt']
+
+
+def test_no_index_for_absolute_headers(tmpdir, monkeypatch):
+    hdr = tmpdir.join('foo.klt')
+    hdr.write('')
+    src = tmpdir.join('prog.kl')
+    write_markers(src, [str(hdr)])
+
+    def fail(*args, **kwargs):
+        raise AssertionError('include dirs should not be indexed')
+    monkeypatch.setattr(ktransw, 'build_incdir_index', fail)
+    assert resolve_deps(str(src), [str(tmpdir)]) == [str(hdr)]